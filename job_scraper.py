@@ -8,24 +8,40 @@ Updates:
 - Noise Filter: Added strict title filtering to manage the broader search volume.
 """
 
-import csv
-from jobspy import scrape_jobs
-import pandas as pd
+import argparse
+import hashlib
+import inspect
+import random
+import re
+import shutil
+import sys
+import time
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+# NOTE: jobspy, pandas, numpy and requests_cache are imported inside the functions
+# that use them, so importing this module (tests, cron wrappers) stays cheap.
+# jobspy must NOT be imported at module level: install_http_cache() has to run first
+# (see the comment there).
 
 # Configuration: Locations
 target_locations = ["San Francisco Bay Area, CA", "Remote"]
 
 # Configuration: Search Verticals
+# `priority` orders local categorization (lowest first): niche verticals are tried before
+# the broad buckets, which are supersets of them.
 searches = [
     # --- TIER 1: BROAD TECH & GEOSPATIAL ---
     {
         "name": "General_Tech_DS",
+        "priority": 6,
         # BROADER: Captures any Python+SQL Data Science role (Product, Core ML, Analytics)
         "query": "(\"Data Scientist\" OR \"Applied Scientist\" OR \"Machine Learning Engineer\") AND (\"Python\") AND (\"SQL\")",
     },
     {
         "name": "Geospatial_Tech",
+        "priority": 5,
         # NEW: Captures Spatial Data Science across all sectors (Logistics, AgriTech, Urban)
         "query": "(\"Geospatial\" OR \"Remote Sensing\" OR \"GIS\" OR \"Spatial Data\") AND (\"Python\")",
     },
@@ -33,114 +49,404 @@ searches = [
     # --- TIER 2: YOUR DOMAIN EXPERTISE (Keep these, they are high signal) ---
     {
         "name": "Climate_Risk_Modeling",
+        "priority": 1,
         "query": "(\"Catastrophe Modeler\" OR \"Risk Analyst\" OR \"Climate Scientist\") AND (\"Wildfire\" OR \"Flood\") AND (\"Python\")",
     },
     {
         "name": "Environmental_Consulting",
+        "priority": 4,
         "query": "(\"Climate Resilience\" OR \"Environmental Planner\" OR \"NEPA\") AND (\"Consulting\" OR \"Arcadis\" OR \"AECOM\" OR \"Jacobs\")",
     },
 
     # --- TIER 3: NICHE HIGH UPSIDE ---
     {
         "name": "Carbon_MRV_ClimateTech",
+        "priority": 2,
         "query": "(\"Remote Sensing\" OR \"Geospatial\" OR \"Data Scientist\") AND (\"Carbon\" OR \"Forestry\" OR \"MRV\" OR \"Nature-based Solutions\") AND (\"Python\")",
     },
     {
         "name": "Quant_Energy_Trading",
+        "priority": 3,
         "query": "(\"Quantitative Researcher\" OR \"Energy Trader\") AND (\"Python\") AND (\"Stochastic\" OR \"Time Series\" OR \"Power\")",
     }
 ]
 
-all_jobs = []
-date_str = datetime.now().strftime('%Y-%m-%d')
+# Configuration: Filters
+forbidden_locs = ["India", "UK", "United Kingdom", "London", "Germany", "France", "Italy", "China", "Australia", "Canada", "Europe", "European", "European Union", "EU"]
+
+# Because we cast a wider net, we need to block non-DS roles that mention "Python"
+forbidden_titles = [
+    "Sales", "Account Executive", "Recruiter", "Marketing Manager", 
+    "Nurse", "Driver", "Technician", "Intern", "Internship", "Unpaid", "Volunteer",
+    "Senior Director", "VP of", "SVP of", "EVP of", "Head of" # Filtering out roles likely too senior for first industry jump
+]
+
+def compile_terms(terms):
+    """Compile a case-insensitive, word-bounded alternation of literal terms (plural "s" allowed)."""
+    return re.compile(r'\b(?:' + '|'.join(map(re.escape, terms)) + r')s?\b', re.IGNORECASE)
+
+# Compiled once so str.contains doesn't rebuild the pattern on every call.
+# Locations are exact place names (no plural suffix), so adjective forms are listed explicitly.
+FORBIDDEN_LOC_RE = re.compile(r'\b(?:' + '|'.join(map(re.escape, forbidden_locs)) + r')\b', re.IGNORECASE)
+
+# Titles are tokenized once per row into word n-grams (up to the longest rule, so phrases
+# like "VP of" work); each title rule is then a set-membership check rather than a regex pass.
+TOKEN_RE = re.compile(r'[a-z0-9+#]+(?:\.[a-z0-9+#]+)*')
+
+def title_words(text):
+    """Lowercased words with a plural "s" stripped, so "Drivers"/"Technicians" match the rules."""
+    return [w[:-1] if len(w) > 3 and w.endswith('s') and not w.endswith('ss') else w
+            for w in TOKEN_RE.findall(text.lower())]
+
+FORBIDDEN_TITLE_TOKENS = frozenset(' '.join(title_words(t)) for t in forbidden_titles)
+MAX_TITLE_RULE_WORDS = max(len(rule.split()) for rule in FORBIDDEN_TITLE_TOKENS)
+
+def title_tokens(title):
+    """Word n-gram tokens (1..MAX_TITLE_RULE_WORDS words) for a job title."""
+    if not isinstance(title, str):
+        return frozenset()
+    words = title_words(title)
+    return frozenset(
+        ' '.join(words[i:i + n])
+        for n in range(1, MAX_TITLE_RULE_WORDS + 1)
+        for i in range(len(words) - n + 1)
+    )
+
+# Configuration: Output (high-value columns)
+OUTPUT_COLUMNS = [
+    'title', 'company', 'site', 'job_url', 'location', 'is_remote',
+    'min_amount', 'max_amount', 'interval', 
+    'date_posted', 'Category'
+]
+
+# Columns the filters read; kept through the early projection even if dropped from OUTPUT_COLUMNS
+FILTER_COLUMNS = ['title', 'company', 'location', 'is_remote', 'date_posted']
+
+# Low-cardinality string columns, loaded as pandas categoricals to keep the frame small
+CATEGORY_COLUMNS = ['site', 'Category', 'interval', 'company']
+
+# HTTP Cache: daily reruns overlap heavily, so serve repeat requests from a local SQLite cache.
+# install_cache patches requests.Session globally, which covers the requests-based jobspy
+# providers (indeed, linkedin, google). glassdoor and zip_recruiter use curl_cffi sessions
+# and are never cached.
+#
+# ORDERING: this must run before jobspy is first imported. jobspy subclasses
+# requests.Session at import time (RequestsRotating); if the patch lands afterwards, that
+# subclass's __init__ calls the patched Session.__init__ and every scrape dies with
+# "TypeError: super(type, obj)". install_http_cache() refuses to run in that case.
+#
+# Connection reuse: jobspy builds a fresh session per provider per call and has no
+# `session` kwarg, so instead every patched session mounts one shared adapter. The
+# adapter owns the urllib3 pool, so keep-alive sockets are reused across the
+# requests-based scrapes.
+def install_http_cache(force_refresh=False):
+    """Install the global SQLite response cache with a shared, pooled HTTP adapter."""
+    if 'jobspy' in sys.modules:
+        raise RuntimeError("install_http_cache() must run before jobspy is imported")
+
+    import requests_cache
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    shared_adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=Retry(total=0))
+
+    class PooledCachedSession(requests_cache.CachedSession):
+        """CachedSession that routes through the process-wide shared adapter."""
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.mount('https://', shared_adapter)
+            self.mount('http://', shared_adapter)
+
+    requests_cache.install_cache(
+        'jobspy_cache',
+        backend='sqlite',
+        expire_after=timedelta(hours=6),
+        allowable_methods=('GET', 'POST'),
+        session_factory=PooledCachedSession
+    )
+    if force_refresh:
+        requests_cache.clear()
+
+# Concurrency: each scrape is independent network I/O, so run them in a thread pool.
+# Kept modest to stay under provider rate limits.
+MAX_WORKERS = 8
+
+# Rate limiting: newer jobspy builds accept `rate_limit_mode` ("aggressive" drops the
+# base page delay from ~5s to ~1.5s with 429 backoff). scrape_jobs swallows unknown
+# kwargs with a FutureWarning, so support is checked on the signature rather than by
+# catching an error.
+RATE_MODE = 'aggressive'
+
+def call_scraper(**kwargs):
+    """Call scrape_jobs, adding rate_limit_mode=RATE_MODE only if this jobspy declares it."""
+    from jobspy import scrape_jobs
+
+    if 'rate_limit_mode' in inspect.signature(scrape_jobs).parameters:
+        kwargs['rate_limit_mode'] = RATE_MODE
+    return scrape_jobs(**kwargs)
+
+# Retries: jobspy never raises on a 429. Each provider logs the error and returns whatever
+# it had, so a fully rate-limited scrape surfaces as an empty frame. Back off
+# (exponential + jitter) and retry that case instead of losing the location. Partial
+# results (one board blocked, others fine) can't be told apart from a quiet day and are kept.
+MAX_ATTEMPTS = 3
+
+def safe_scrape(label, attempts=MAX_ATTEMPTS, **kwargs):
+    """call_scraper, retried with backoff while it comes back empty. Returns the last result."""
+    for attempt in range(attempts):
+        jobs = call_scraper(**kwargs)
+        if not jobs.empty or attempt == attempts - 1:
+            return jobs
+        delay = (2 ** attempt) + random.random()
+        print(f"   Empty result in {label} (possibly rate limited); retrying in {delay:.1f}s (attempt {attempt + 2}/{attempts})...")
+        time.sleep(delay)
+
+# Batching: one combined query per location instead of one per (vertical, location).
+# Categories are assigned afterwards by matching each vertical's terms locally.
+COMBINED_QUERY = ' OR '.join(f"({search['query']})" for search in searches)
+RESULTS_PER_VERTICAL = 15
+
+def query_patterns(query):
+    """Split a Boolean vertical query into one compiled pattern per AND-group of quoted terms."""
+    return [compile_terms(re.findall(r'"([^"]+)"', group)) for group in query.split(' AND ')]
+
+# np.select is first-match-wins, so verticals are tried from most to least specific
+VERTICAL_PATTERNS = {
+    search['name']: query_patterns(search['query'])
+    for search in sorted(searches, key=lambda search: search['priority'])
+}
+
+def assign_categories(jobs):
+    """Label each row with the first vertical whose every AND-group matches its title/description.
+
+    Rows with no full match fall back to the first vertical whose role terms (the first
+    AND-group) match the title, then to 'Uncategorized'. Nothing is dropped here.
+    """
+    import numpy as np
+    import pandas as pd
+
+    title = jobs['title'].fillna('')
+    text = title
+    if 'description' in jobs.columns:
+        text = text + ' ' + jobs['description'].fillna('')
+
+    full_matches = []
+    title_matches = []
+    for patterns in VERTICAL_PATTERNS.values():
+        mask = pd.Series(True, index=jobs.index)
+        for pattern in patterns:
+            mask &= text.str.contains(pattern, na=False)
+        full_matches.append(mask)
+        title_matches.append(title.str.contains(patterns[0], na=False))
+
+    names = list(VERTICAL_PATTERNS)
+    return np.select(full_matches + title_matches, names + names, default='Uncategorized')
+
+# Checkpoints: each location's scrape is staged to parquet as soon as it lands, so a crash
+# later in the run doesn't lose it and a re-run within STAGING_MAX_AGE skips the scrape.
+# File names carry a hash of the query/category config, so editing `searches` (or their
+# priorities) never resumes rows categorized under the old config.
+STAGING_ROOT = Path('.staging')
+STAGING_MAX_AGE = timedelta(hours=6)
+CONFIG_HASH = hashlib.sha1(
+    (COMBINED_QUERY + '|' + ','.join(VERTICAL_PATTERNS)).encode()
+).hexdigest()[:8]
 
-print(f"--- Starting Wide-Net Market Scan: {date_str} ---")
+def prepare_staging(date_str):
+    """Create today's staging dir and prune earlier dates. Returns None if staging is unavailable."""
+    staging_dir = STAGING_ROOT / date_str
+    try:
+        if STAGING_ROOT.exists():
+            for old_dir in STAGING_ROOT.iterdir():
+                if old_dir.is_dir() and old_dir.name != date_str:
+                    shutil.rmtree(old_dir)
+        staging_dir.mkdir(parents=True, exist_ok=True)
+    except OSError as e:
+        # Checkpoints are an optimisation; never let them fail the run
+        print(f"   Checkpoint error preparing {staging_dir}: {e} (continuing without checkpoints)")
+        return None
+    return staging_dir
 
-# Execute Scraper
-for search in searches:
-    for loc in target_locations:
-        print(f"Querying {search['name']} in {loc}...")
-        
-        google_query = f"{search['query']} jobs in {loc}"
-        
+def staging_path(staging_dir, loc):
+    """Per-location checkpoint file, e.g. .staging/2025-12-03/combined_remote_1a2b3c4d.parquet."""
+    loc_slug = re.sub(r'[^a-z0-9]+', '_', loc.lower()).strip('_')
+    return staging_dir / f"combined_{loc_slug}_{CONFIG_HASH}.parquet"
+
+def run_search(loc, staging_dir, force_refresh=False):
+    """Scrape every vertical for one location in a single batched query. Returns a tagged DataFrame or None.
+
+    A checkpoint younger than STAGING_MAX_AGE is reused unless force_refresh is set.
+    staging_dir may be None, in which case nothing is read from or written to disk.
+    """
+    import pandas as pd
+
+    checkpoint = staging_path(staging_dir, loc) if staging_dir is not None else None
+    if checkpoint is not None and checkpoint.exists() and not force_refresh:
+        age = datetime.now() - datetime.fromtimestamp(checkpoint.stat().st_mtime)
+        if age < STAGING_MAX_AGE:
+            jobs = pd.read_parquet(checkpoint)
+            print(f"   Resumed {len(jobs)} staged roles in {loc} from {checkpoint}.")
+            return jobs
+
+    google_query = f"{COMBINED_QUERY} jobs in {loc}"
+
+    try:
+        jobs = safe_scrape(
+            f"Combined query ({loc})",
+            site_name=["linkedin", "indeed", "glassdoor", "zip_recruiter", "google"],
+            search_term=COMBINED_QUERY,
+            google_search_term=google_query,
+            location=loc,
+            results_wanted=RESULTS_PER_VERTICAL * len(searches),
+            hours_old=168, # 7 Days
+            country_urlpatterns='USA'
+            # fetch_description is deliberately left off: it adds a detail request per job
+            # for LinkedIn and ZipRecruiter (plus Glassdoor batches), ~180 extra requests per
+            # location. Rows without a description are categorized on their title instead.
+        )
+    except Exception as e:
+        print(f"   Pipeline error in combined query ({loc}): {e}")
+        return None
+
+    if jobs.empty:
+        print(f"   No fresh data found in {loc}.")
+        return None
+
+    jobs['Category'] = assign_categories(jobs)
+    print(f"   Signal found: {len(jobs)} new roles in {loc}.")
+
+    # Project down now that categorization (the only consumer of `description` and the
+    # rest of jobspy's wide schema) is done, so dedupe/filter masks work on narrow frames
+    keep = OUTPUT_COLUMNS + [col for col in FILTER_COLUMNS if col not in OUTPUT_COLUMNS]
+    jobs = jobs[[col for col in keep if col in jobs.columns]]
+
+    # Write-then-rename so an interrupted write never leaves a half checkpoint behind.
+    # A failed checkpoint must not cost us the scrape itself, so log and carry on.
+    if checkpoint is not None:
+        tmp_path = checkpoint.with_suffix('.tmp')
         try:
-            jobs = scrape_jobs(
-                site_name=["linkedin", "indeed", "glassdoor", "zip_recruiter", "google"],
-                search_term=search['query'],
-                google_search_term=google_query,
-                location=loc,
-                results_wanted=15, 
-                hours_old=168, # 7 Days
-                country_urlpatterns='USA'
-            )
-            
-            if not jobs.empty:
-                jobs['Category'] = search['name']
-                jobs['Search_Location'] = loc
-                all_jobs.append(jobs)
-                print(f"   Signal found: {len(jobs)} new roles.")
-            else:
-                print("   No fresh data found.")
-                
+            jobs.to_parquet(tmp_path, index=False)
+            tmp_path.replace(checkpoint)
         except Exception as e:
-            print(f"   Pipeline error in {search['name']} ({loc}): {e}")
+            print(f"   Checkpoint error for {loc} ({checkpoint}): {e}")
+            tmp_path.unlink(missing_ok=True)
+    return jobs
 
-# Data Cleaning & Export
-if all_jobs:
-    master_df = pd.concat(all_jobs, ignore_index=True)
+# Data Cleaning
+def dedupe_jobs(jobs, seen_keys):
+    """Drop postings already written this run (same company + title across boards). Updates seen_keys.
+
+    Call on filtered rows only: every row kept here is added to seen_keys.
+    """
+    dedup_key = (
+        jobs['company'].fillna('').str.lower() + '|' + jobs['title'].fillna('').str.lower()
+    ).str.replace(r'\s+', ' ', regex=True).str.strip()
+
+    new_mask = ~dedup_key.duplicated() & ~dedup_key.isin(seen_keys)
+    seen_keys.update(dedup_key[new_mask])
+    return jobs[new_mask]
+
+def clean_jobs(jobs):
+    """Apply the date, location and title filters to one scrape and project to OUTPUT_COLUMNS."""
+    import pandas as pd
+
+    # Every mask is built against the unfiltered frame and applied in one indexing
+    # step, so only a single filtered copy is ever materialized.
 
     # --- 1. STRICT DATE FILTER ---
-    master_df = master_df.dropna(subset=['date_posted'])
-    master_df['date_posted'] = pd.to_datetime(master_df['date_posted']).dt.date
-    cutoff_date = (datetime.now() - timedelta(days=7)).date()
-    master_df = master_df[master_df['date_posted'] >= cutoff_date]
+    # Kept as datetime64 so the comparison (and the later sort) runs on int64, not Python dates
+    jobs = jobs.assign(date_posted=pd.to_datetime(jobs['date_posted'], errors='coerce'))
+    cutoff = pd.Timestamp.now().normalize() - pd.Timedelta(days=7)
+    date_mask = jobs['date_posted'] >= cutoff
 
     # --- 2. INTERNATIONAL FIREWALL ---
-    forbidden_locs = ["India", "UK", "United Kingdom", "London", "Germany", "France", "Italy", "China", "Australia", "Canada", "Europe"]
-    loc_pattern = '|'.join(forbidden_locs)
-    master_df = master_df[~master_df['location'].str.contains(loc_pattern, case=False, na=False)]
+    intl_mask = ~jobs['location'].str.contains(FORBIDDEN_LOC_RE, na=False)
 
     # --- 3. NOISE FILTER (Forbidden Titles) ---
-    # Because we cast a wider net, we need to block non-DS roles that mention "Python"
-    forbidden_titles = [
-        "Sales", "Account Executive", "Recruiter", "Marketing Manager", 
-        "Nurse", "Driver", "Technician", "Intern", "Unpaid", "Volunteer",
-        "Senior Director", "VP of", "Head of" # Filtering out roles likely too senior for first industry jump
-    ]
-    title_pattern = '|'.join(forbidden_titles)
-    master_df = master_df[~master_df['title'].str.contains(title_pattern, case=False, na=False)]
+    tokens = jobs['title'].map(title_tokens)
+    title_mask = tokens.map(FORBIDDEN_TITLE_TOKENS.isdisjoint).astype(bool)
 
     # --- 4. THE "CALIFORNIA OR REMOTE" RULE ---
-    def is_valid_location(row):
-        loc = str(row['location']).lower()
-        is_remote = row.get('is_remote')
-        
-        if "ca" in loc or "california" in loc or "san francisco" in loc or "oakland" in loc or "san jose" in loc:
-            return True
-        if is_remote is True:
-            return True
-        if "remote" in loc:
-            return True
-        return False
-
-    master_df = master_df[master_df.apply(is_valid_location, axis=1)]
-
-    # Select high-value columns
-    desired_columns = [
-        'title', 'company', 'site', 'job_url', 'location', 'is_remote',
-        'min_amount', 'max_amount', 'interval', 
-        'date_posted', 'Category'
-    ]
-    
-    available_columns = [col for col in desired_columns if col in master_df.columns]
-    clean_df = master_df[available_columns]
+    loc_lower = jobs['location'].fillna('').str.lower()
+    ca_mask = loc_lower.str.contains(r'\b(?:ca|california|san francisco|oakland|san jose)\b', regex=True, na=False)
+    remote_mask = loc_lower.str.contains('remote', na=False)
+    if 'is_remote' in jobs.columns:
+        remote_mask |= jobs['is_remote'] == True
 
-    # --- 5. SORT BY RECENCY ---
-    clean_df = clean_df.sort_values(by='date_posted', ascending=False)
-    
+    final_mask = date_mask & intl_mask & title_mask & (ca_mask | remote_mask)
+
+    # Fixed schema so every streamed chunk lines up under the same CSV header
+    missing = [col for col in OUTPUT_COLUMNS if col not in jobs.columns]
+    if missing:
+        jobs = jobs.assign(**{col: None for col in missing})
+
+    return jobs.loc[final_mask, OUTPUT_COLUMNS].copy()
+
+def main():
+    import pandas as pd
+
+    # CLI
+    parser = argparse.ArgumentParser(description="Wide-Net job market scan.")
+    parser.add_argument('--force-refresh', action='store_true',
+                        help="Clear the on-disk HTTP cache, ignore staged checkpoints and fetch everything fresh.")
+    args = parser.parse_args()
+
+    install_http_cache(force_refresh=args.force_refresh)
+
+    date_str = datetime.now().strftime('%Y-%m-%d')
+
+    print(f"--- Starting Wide-Net Market Scan: {date_str} ---")
+
+    # Execute Scraper
+    # Each location's scrape is filtered and appended to the CSV as it lands, so only one
+    # scrape's worth of rows is held in memory at a time.
     filename = f"market_scan_WideNet_{date_str}.csv"
-    clean_df.to_csv(filename, index=False)
-    
-    print(f"\nPipeline complete. {len(clean_df)} valid, sorted jobs saved to {filename}")
-else:
-    print("\nScan complete. No new listings found matching criteria.")
\ No newline at end of file
+    staging_dir = prepare_staging(date_str)
+    rows_written = 0
+    seen_keys = set()
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = []
+        for loc in target_locations:
+            print(f"Querying all {len(searches)} verticals in {loc}...")
+            futures.append(executor.submit(run_search, loc, staging_dir, args.force_refresh))
+
+        for future in as_completed(futures):
+            jobs = future.result()
+            if jobs is None:
+                continue
+
+            # Dedupe only rows that passed the filters, so a rejected copy of a posting
+            # (e.g. the London listing) can't shadow a valid one (the SF listing)
+            clean_df = dedupe_jobs(clean_jobs(jobs), seen_keys)
+            if clean_df.empty:
+                continue
+
+            first_chunk = rows_written == 0
+            clean_df.to_csv(filename, index=False, mode='w' if first_chunk else 'a', header=first_chunk)
+            rows_written += len(clean_df)
+
+    # Export
+    if rows_written:
+        # --- 5. SORT BY RECENCY ---
+        # Single post-pass over the (already filtered, so small) output file
+        clean_df = pd.read_csv(
+            filename,
+            parse_dates=['date_posted'],
+            dtype={col: 'category' for col in CATEGORY_COLUMNS if col in OUTPUT_COLUMNS}
+        )
+        clean_df = clean_df.sort_values(by='date_posted', ascending=False)
+        clean_df.to_csv(filename, index=False)
+
+        # Arrow-backed copy for downstream analysis; the CSV stays for human review.
+        # Columns are already category/datetime64 from read_csv, so Arrow avoids object fallback.
+        parquet_filename = f"market_scan_WideNet_{date_str}.parquet"
+        clean_df.to_parquet(parquet_filename, index=False, compression='zstd')
+
+        print(f"\nPipeline complete. {len(clean_df)} valid, sorted jobs saved to {filename} (+ {parquet_filename})")
+    else:
+        print("\nScan complete. No new listings found matching criteria.")
+
+
+if __name__ == '__main__':
+    main()